@@ -1,104 +1,296 @@
-import streamlit as st
-import json
-import threading
+import os
+from collections import deque
 from datetime import datetime
+from itertools import islice
+
+import numpy as np
+import streamlit as st
+from streamlit_autorefresh import st_autorefresh
 
 try:
-    import paho.mqtt.client as mqtt
+    import plotly.graph_objects as go
 except ImportError:
-    mqtt = None
+    go = None
+
+from demo_mode import TankLevelSimulator
+from pump_controller import ConfigManager, PumpController
+import pump_controller
+
 
 @st.cache_resource
-def load_config():
-    with open("config.json") as f:
-        return json.load(f)
+def get_pump_controller():
+    """Controlador singleton compartit per totes les sessions.
+
+    El fil de control i el subscriptor MQTT arrenquen aquí una sola vegada;
+    les pestanyes del dashboard només llegeixen el seu estat.
+    """
+    controller = PumpController(ConfigManager())
+    controller.start()
+    if pump_controller.mqtt is None:
+        # Sense paho-mqtt (entorn de desenvolupament): nivells simulats.
+        TankLevelSimulator(controller.tank_monitor).start()
+    return controller
+
+
+controller = get_pump_controller()
+config = controller.config
+
+
+def _historic_mtime():
+    try:
+        return os.path.getmtime(controller.historic.historic_file)
+    except OSError:
+        return 0.0
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_recent(mtime):
+    """Taula dels últims 30 dies, memoritzada per mtime del fitxer.
+
+    El fitxer només canvia quan es registra una maniobra; amb la mtime com
+    a clau, els reruns de l'autorefresh reutilitzen el resultat en lloc de
+    rellegir el CSV cada 3 segons.
+    """
+    return get_pump_controller().historic.get_last_30_days()
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _compute_stats(mtime):
+    """Estadístiques de l'històric, calculades en una sola travessa.
+
+    Retorna els quatre escalars de les mètriques i el value_counts per al
+    gràfic de barres; els reruns calents només desempaqueten el dict.
+    """
+    df = get_pump_controller().historic.get_historic_data(
+        usecols=["Durada_min", "Tipus_Maniobra"]
+    )
+    if df.empty:
+        return {"n": 0, "avg": 0.0, "sum": 0.0, "programmed": 0, "tipus_counts": None}
+    n, avg, total = df["Durada_min"].agg(["count", "mean", "sum"])
+    tipus_counts = df["Tipus_Maniobra"].value_counts(sort=False, dropna=False)
+    return {
+        "n": int(n),
+        "avg": float(np.nan_to_num(avg)),
+        "sum": float(total),
+        "programmed": int(tipus_counts.get("programada", 0)),
+        "tipus_counts": tipus_counts,
+    }
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_chart_columns(mtime):
+    """Columnes del gràfic de nivells, memoritzades per mtime del fitxer.
+
+    Només es parsegen les tres columnes que el gràfic fa servir, no tot el
+    CSV plurianual, i només quan el fitxer canvia — no a cada rerun de
+    l'autorefresh. L'ordenació queda dins la cache: les files s'escriuen en
+    ordre cronològic, així que sol ser un no-op.
+    """
+    df = get_pump_controller().historic.get_historic_data(
+        usecols=["Data_Inici", "Nivell_Baix_Inicial", "Nivell_Alt_Inicial"]
+    )
+    if df.empty or df["Data_Inici"].is_monotonic_increasing:
+        return df
+    return df.sort_values("Data_Inici")
+
 
-cfg = load_config()
+@st.cache_data(show_spinner=False)
+def _csv_bytes(mtime):
+    """Bytes del CSV de descàrrega, serialitzats un cop per canvi de dades."""
+    df = _load_recent(mtime)
+    return df.to_csv(sep=";", index=False, date_format="%Y-%m-%d").encode()
 
-if "levels" not in st.session_state:
-    st.session_state["levels"] = {"baix": 0, "alt": 0}
 if "history" not in st.session_state:
-    st.session_state["history"] = []
+    # deque amb maxlen: el límit de 100 entrades s'aplica en C, sense
+    # recrear la llista (ni reassignar session_state) a cada esdeveniment.
+    st.session_state["history"] = deque(maxlen=100)
+
 
 def log_event(tipus, info):
     st.session_state["history"].append(
         {"hora": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "tipus": tipus, "info": info}
     )
-    st.session_state["history"] = st.session_state["history"][-100:]
-
-# MQTT
-def mqtt_bg():
-    def on_connect(client, userdata, flags, rc):
-        client.subscribe(cfg["mqtt_topic_baix"])
-        client.subscribe(cfg["mqtt_topic_alt"])
-    def on_message(client, userdata, msg):
-        try:
-            val = float(msg.payload.decode())
-        except Exception:
-            val = 0
-        if msg.topic.endswith("baix"):
-            st.session_state["levels"]["baix"] = val
-        elif msg.topic.endswith("alt"):
-            st.session_state["levels"]["alt"] = val
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.connect(cfg["mqtt_broker"], cfg["mqtt_port"], cfg["mqtt_keepalive"])
-    client.loop_forever()
-
-if mqtt and "mqtt_started" not in st.session_state:
-    threading.Thread(target=mqtt_bg, daemon=True).start()
-    st.session_state["mqtt_started"] = True
-
-# Enviar ordres de relé via MQTT
-def publish_relay(relay, action):
-    if not mqtt:
-        log_event("ERROR", "MQTT no disponible")
+
+
+try:
+    _fragment = st.fragment  # Streamlit >= 1.37
+except AttributeError:  # versions antigues: decorador transparent
+    def _fragment(func):
+        return func
+
+
+def led(label, on):
+    color = "🟢" if on else "🔴"
+    st.write(f"{color} {label}")
+
+
+def monitoring_tab():
+    levels = controller.tank_monitor.levels
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Nivell dipòsit baix (%)", f"{levels['baix']:.1f}")
+        st.progress(min(max(int(levels["baix"]), 0), 100))
+    with col2:
+        st.metric("Nivell dipòsit alt (%)", f"{levels['alt']:.1f}")
+        st.progress(min(max(int(levels["alt"]), 0), 100))
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        led("Maniobra en marxa", controller.pump_running)
+    with col2:
+        led("Relé 3", controller.relay_controller.relay3_active)
+    with col3:
+        led("Relé 4", controller.relay_controller.relay4_active)
+
+    st.write(f"**Ara:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    if controller.pump_start_time is not None:
+        st.write(f"**Maniobra iniciada:** {controller.pump_start_time.strftime('%H:%M:%S')}")
+    if controller.last_operation_date is not None:
+        st.write(f"**Última maniobra amb arrencada:** {controller.last_operation_date}")
+    st.write(f"**Propera maniobra programada:** {controller.next_scheduled().strftime('%Y-%m-%d %H:%M')}")
+
+    manual = st.toggle("Maniobra manual", value=controller.pump_running and controller.manual_mode)
+    if manual and not controller.pump_running:
+        if controller.start_manual():
+            log_event("MANUAL", "Maniobra manual iniciada")
+        else:
+            log_event("ERROR", "No es compleixen les condicions d'arrencada")
+    elif not manual and controller.pump_running and controller.manual_mode:
+        controller.stop_pump()
+        log_event("MANUAL", "Maniobra manual aturada")
+
+    st.write("### Esdeveniments de la sessió")
+    for evt in islice(reversed(st.session_state["history"]), 10):
+        st.write(f"{evt['hora']} | {evt['tipus']} | {evt['info']}")
+
+
+@_fragment
+def history_tab():
+    mtime = _historic_mtime()
+    stats = _compute_stats(mtime)
+    if stats["n"] == 0:
+        st.info("No hi ha dades disponibles encara")
         return
-    client = mqtt.Client()
-    client.connect(cfg["mqtt_broker"], cfg["mqtt_port"], cfg["mqtt_keepalive"])
-    topic = cfg[f"mqtt_topic_{relay}"]
-    payload = "ON" if action == "on" else "OFF"
-    client.publish(topic, payload)
-    client.disconnect()
-    log_event("RELAY", f"{relay} -> {payload}")
-
-# Refresc automàtic - sense dependre de cap paquet extern!
-def autorefresh(interval_ms=3000):
-    st.markdown(
-        f"""
-        <script>
-        function refresh() {{
-            window.location.reload();
-        }}
-        setTimeout(refresh, {interval_ms});
-        </script>
-        """,
-        unsafe_allow_html=True,
+
+    st.subheader("Estadístiques")
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Maniobres", stats["n"])
+    col2.metric("Durada mitjana (min)", f"{stats['avg']:.2f}")
+    col3.metric("Temps total (min)", f"{stats['sum']:.1f}")
+    col4.metric("Programades", stats["programmed"])
+
+    st.subheader("Nivells a l'inici de cada maniobra")
+    df_sorted = _load_chart_columns(mtime)
+    if go is not None:
+        # Figura nova a cada rerun: construir dues traces és barat, i una
+        # figura compartida via cache_resource es mutaria sense sincronitzar
+        # des de totes les sessions (plotly_chart la reserialitza igualment).
+        x = df_sorted["Data_Inici"]
+        fig = go.Figure()
+        fig.add_scatter(
+            name="Dipòsit Baix",
+            mode="lines",
+            x=x,
+            y=df_sorted["Nivell_Baix_Inicial"].to_numpy(np.float32),
+        )
+        fig.add_scatter(
+            name="Dipòsit Alt",
+            mode="lines",
+            x=x,
+            y=df_sorted["Nivell_Alt_Inicial"].to_numpy(np.float32),
+        )
+        fig.update_layout(yaxis_title="%", margin=dict(l=0, r=0, t=10, b=0))
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        # set_index + selecció de columnes crea una vista sobre els mateixos
+        # arrays; un dict literal copiaria les dues columnes a cada rerun.
+        chart_data = df_sorted.set_index("Data_Inici")[
+            ["Nivell_Baix_Inicial", "Nivell_Alt_Inicial"]
+        ].rename(
+            columns={"Nivell_Baix_Inicial": "Dipòsit Baix", "Nivell_Alt_Inicial": "Dipòsit Alt"}
+        )
+        st.line_chart(chart_data)
+    st.bar_chart(stats["tipus_counts"])
+
+    st.subheader("Últims 30 dies")
+    recent_df = _load_recent(mtime)
+    if not recent_df.empty:
+        st.dataframe(recent_df, use_container_width=True)
+        st.download_button(
+            "Descarrega CSV", _csv_bytes(mtime), file_name="historic_30d.csv", mime="text/csv"
+        )
+    else:
+        st.info("Encara no hi ha maniobres registrades")
+
+
+def parameters_tab():
+    st.subheader("Paràmetres del sistema")
+    # strptime reinterpreta el format a cada crida; el valor per defecte
+    # només canvia quan l'usuari desa, així que es parseja un sol cop.
+    default_hora = st.session_state.setdefault(
+        "_hora_maniobra_default",
+        datetime.strptime(config.get("hora_maniobra", "12:00"), "%H:%M").time(),
     )
-autorefresh(3000)  # refresca cada 3 segons
+    with st.form("parametres"):
+        broker = st.text_input("Adreça IP broker MQTT", value=config.get("mqtt_broker", ""))
+        hora = st.time_input("Hora maniobra", value=default_hora)
+        durada = st.number_input(
+            "Durada màxima maniobra (min)", 2, 5, config.get("durada_max_maniobra", 3)
+        )
+        periode_mant = st.number_input(
+            "Període manteniment (dies)", 7, 15, config.get("periode_manteniment", 10)
+        )
+        temps_mant = st.number_input(
+            "Temps maniobra manteniment (s)", 5, 15, config.get("temps_manteniment", 10)
+        )
+        durada_manual = st.number_input(
+            "Durada màxima manual (min)", 5, 30, config.get("durada_max_manual", 10)
+        )
+        retencio = st.number_input(
+            "Retenció històric (anys)", 2, 10, config.get("retencio_historic_anys", 5)
+        )
+        email_to = st.text_input("Email destinatari", value=config.get("email_to", ""))
+        email_user = st.text_input("Email remitent", value=config.get("email_user", ""))
+        email_pass = st.text_input(
+            "Contrasenya SMTP", value=config.get("email_pass", ""), type="password"
+        )
+        ubicacio = st.text_input("Ubicació", value=config.get("ubicacio", ""))
+        if st.form_submit_button("Desa"):
+            config.save(
+                {
+                    "mqtt_broker": broker,
+                    "hora_maniobra": hora.strftime("%H:%M"),
+                    "durada_max_maniobra": int(durada),
+                    "periode_manteniment": int(periode_mant),
+                    "temps_manteniment": int(temps_mant),
+                    "durada_max_manual": int(durada_manual),
+                    "retencio_historic_anys": int(retencio),
+                    "email_to": email_to,
+                    "email_user": email_user,
+                    "email_pass": email_pass,
+                    "ubicacio": ubicacio,
+                }
+            )
+            st.session_state["_hora_maniobra_default"] = hora
+            st.success("Configuració desada")
+            log_event("CONFIG", "Paràmetres actualitzats")
+
 
 # UI
 st.set_page_config(page_title="Control Bomba d'Aigua", layout="centered")
 st.title("Control Bomba d'Aigua")
 
-st.metric("Nivell dipòsit baix (%)", st.session_state["levels"]["baix"])
-st.metric("Nivell dipòsit alt (%)", st.session_state["levels"]["alt"])
-
-col1, col2 = st.columns(2)
-
-with col1:
-    if st.button("Arrenca MANUAL"):
-        publish_relay("relay3", "on")
-        publish_relay("relay4", "on")
-with col2:
-    if st.button("PARADA"):
-        publish_relay("relay3", "off")
-        publish_relay("relay4", "off")
+# Rerun lleuger del script cada 3 s: només viatja el diff de widgets pel
+# websocket, no una recàrrega completa de la pàgina com feia el JS antic.
+st_autorefresh(interval=3000, key="ui_refresh")
 
-st.write("### Històric últimes maniobres")
-for evt in reversed(st.session_state["history"][-10:]):
-    st.write(f"{evt['hora']} | {evt['tipus']} | {evt['info']}")
+tab_monitor, tab_historic, tab_params = st.tabs(["Monitorització", "Històric", "Paràmetres"])
+with tab_monitor:
+    monitoring_tab()
+with tab_historic:
+    history_tab()
+with tab_params:
+    parameters_tab()
 
 st.write("---")
-st.caption("Dashboard per control remot de bomba d'aigua via MQTT + Streamlit. Refresc automàtic sense dependències!")
+st.caption("Dashboard per control remot de bomba d'aigua via MQTT + Streamlit.")
@@ -0,0 +1,47 @@
+"""Mode demostració: simula els nivells dels dipòsits sense broker MQTT.
+
+Permet provar el dashboard i la lògica de control en un PC de
+desenvolupament on no hi ha ni Venus OS ni paho-mqtt. El simulador manté
+els nivells com a vectors NumPy (SoA), de manera que simular N
+instal·lacions alhora costa el mateix que una: cada tick són un parell
+d'operacions vectoritzades en C, no un bucle Python per dipòsit.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+
+class TankLevelSimulator:
+    """Genera nivells plausibles i els injecta al TankLevelMonitor.
+
+    El dipòsit d'índex 0 alimenta el monitor; la resta (si n_tanks > 1)
+    serveixen per a proves de càrrega del dashboard.
+    """
+
+    def __init__(self, monitor, interval_s=5, n_tanks=1):
+        self.monitor = monitor
+        self.interval_s = interval_s
+        self.n_tanks = n_tanks
+        self.low = np.full(n_tanks, 45.0, dtype=np.float32)
+        self.high = np.full(n_tanks, 75.0, dtype=np.float32)
+        self.rng = np.random.default_rng()
+        self.running = False
+
+    def _simulation_loop(self):
+        while self.running:
+            self.low += self.rng.uniform(-0.5, 0.3, size=self.n_tanks).astype(np.float32)
+            self.high += self.rng.uniform(-0.3, 0.5, size=self.n_tanks).astype(np.float32)
+            np.clip(self.low, 0.0, 100.0, out=self.low)
+            np.clip(self.high, 0.0, 100.0, out=self.high)
+            self.monitor.levels["baix"] = float(self.low[0])
+            self.monitor.levels["alt"] = float(self.high[0])
+            time.sleep(self.interval_s)
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._simulation_loop, daemon=True).start()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,564 @@
+"""Lògica de control de la bomba d'aigua.
+
+Aquest mòdul concentra tota la lògica que abans vivia dins del script de
+Streamlit: lectura de nivells via MQTT (Venus OS), control dels relés del
+HAT PiRelay-V2, registre de l'històric a CSV i la maniobra automàtica
+diària. El dashboard només llegeix l'estat del controlador; les decisions
+es prenen en un fil de fons independent dels reruns de Streamlit.
+"""
+
+import csv
+import json
+import logging
+import os
+import smtplib
+import threading
+import time
+from datetime import date, datetime, timedelta
+from email.mime.text import MIMEText
+from types import MappingProxyType
+
+import pandas as pd
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+# Lligam local resolt un sol cop: evita l'atribut mqtt.Client (i el test de
+# disponibilitat) a cada arrencada de client.
+_MqttClient = mqtt.Client if mqtt else None
+
+try:
+    from gpiozero import OutputDevice
+except ImportError:
+    OutputDevice = None
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = "config.json"
+HISTORIC_FILE = "historic.csv"
+# Dtypes compactes per a la lectura de l'històric: categoria per al tipus
+# (poques etiquetes úniques) i float32 per a percentatges i durades — la
+# meitat d'amplada que float64, de sobres per a una resolució de 0,1.
+HISTORIC_DTYPES = {
+    "Tipus_Maniobra": "category",
+    "Durada_min": "float32",
+    "Nivell_Baix_Inicial": "float32",
+    "Nivell_Alt_Inicial": "float32",
+    "Nivell_Baix_Final": "float32",
+    "Nivell_Alt_Final": "float32",
+}
+HISTORIC_COLUMNS = [
+    "Data_Inici",
+    "Hora_Inici",
+    "Data_Final",
+    "Hora_Final",
+    "Durada_min",
+    "Nivell_Baix_Inicial",
+    "Nivell_Alt_Inicial",
+    "Nivell_Baix_Final",
+    "Nivell_Alt_Final",
+    "Tipus_Maniobra",
+]
+
+
+class ConfigManager:
+    """Llegeix i desa la configuració del sistema (config.json)."""
+
+    __slots__ = ("path", "data", "view")
+
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        with open(self.path, encoding="utf-8") as f:
+            self.data = json.load(f)
+        # Vista de només lectura per compartir amb els fils de fons: cap
+        # component pot mutar la configuració per accident, i save() s'hi
+        # reflecteix perquè embolcalla el mateix dict.
+        self.view = MappingProxyType(self.data)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def save(self, updates):
+        """Actualitza els paràmetres indicats i reescriu config.json."""
+        self.data.update(updates)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2, ensure_ascii=False)
+
+
+class TankLevelMonitor:
+    """Subscriptor MQTT dels nivells dels dos dipòsits (GX Tank 140).
+
+    El Venus OS publica els nivells com a fracció 0-1 dins d'un JSON
+    ``{"value": 0.42}``; aquí es normalitzen a percentatge 0-100.
+    """
+
+    __slots__ = ("config", "levels", "last_update", "connected", "client")
+
+    def __init__(self, config):
+        self.config = config
+        self.levels = {"baix": 0.0, "alt": 0.0}
+        self.last_update = {"baix": None, "alt": None}
+        self.connected = False
+        self.client = None
+
+    def topics(self):
+        device_id = self.config.get("victron_device_id", "")
+        return [f"N/{device_id}/tank/3/Level", f"N/{device_id}/tank/4/Level"]
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        # paho >= 2 passa un ReasonCode (i properties); paho 1.x, un int.
+        failed = rc.is_failure if hasattr(rc, "is_failure") else rc != 0
+        self.connected = not failed
+        if failed:
+            logger.error("Connexió MQTT rebutjada (rc=%s)", rc)
+            return
+        for topic in self.topics():
+            client.subscribe(topic)
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected = False
+
+    def _on_message(self, client, userdata, msg):
+        raw = msg.payload
+        if raw[:1] != b"{":
+            # Payload numèric pur: float() accepta bytes directament i ens
+            # estalviem la descodificació a str a cada missatge.
+            try:
+                value = float(raw)
+            except ValueError:
+                return
+        else:
+            try:
+                value = float(json.loads(raw).get("value", 0))
+            except (ValueError, TypeError):
+                return
+        if "/tank/3/" in msg.topic:
+            tank = "baix"
+        elif "/tank/4/" in msg.topic:
+            tank = "alt"
+        else:
+            return
+        # El Venus publica fraccions 0-1; les sondes de prova, percentatges.
+        self.levels[tank] = value * 100 if value <= 1.0 else value
+        self.last_update[tank] = datetime.now()
+
+    def start(self):
+        """Arrenca el client MQTT persistent (si paho està disponible).
+
+        Un únic client viu tota la sessió: loop_start() li dona el seu fil
+        de xarxa amb reconnexió automàtica, i el mateix client serveix per
+        publicar sense pagar el handshake TCP+CONNECT per missatge.
+        """
+        if _MqttClient is None:
+            logger.warning("paho-mqtt no disponible; nivells no actualitzats")
+            return False
+        # paho >= 2 exigeix la versió de l'API de callbacks al constructor;
+        # sense aquest branc, mqtt.Client() hi aixeca TypeError i tomba tot
+        # el dashboard a l'arrencada.
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            self.client = _MqttClient(mqtt.CallbackAPIVersion.VERSION2)
+        else:
+            self.client = _MqttClient()
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.connect_async(
+            self.config.get("mqtt_broker"),
+            self.config.get("mqtt_port", 1883),
+            self.config.get("mqtt_keepalive_s", 60),
+        )
+        self.client.loop_start()
+        return True
+
+    def publish(self, topic, payload, qos=0):
+        """Publica pel client persistent; retorna False si no hi ha MQTT."""
+        if self.client is None:
+            return False
+        self.client.publish(topic, payload, qos=qos)
+        return True
+
+
+class MockRelay:
+    """Substitut de gpiozero per a entorns sense GPIO (desenvolupament)."""
+
+    __slots__ = ("pin", "is_active")
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.is_active = False
+
+    def on(self):
+        self.is_active = True
+        logger.debug("MockRelay GPIO%s -> ON", self.pin)
+
+    def off(self):
+        self.is_active = False
+        logger.debug("MockRelay GPIO%s -> OFF", self.pin)
+
+    def close(self):
+        pass
+
+
+class RelayController:
+    """Control dels relés 3 i 4 del HAT PiRelay-V2 via gpiozero."""
+
+    __slots__ = ("relay3", "relay4", "_r3_state", "_r4_state")
+
+    def __init__(self, config):
+        pin3 = config.get("relay3_gpio", 6)
+        pin4 = config.get("relay4_gpio", 5)
+        if OutputDevice is not None:
+            try:
+                self.relay3 = OutputDevice(pin3, active_high=True, initial_value=False)
+                self.relay4 = OutputDevice(pin4, active_high=True, initial_value=False)
+            except Exception as exc:
+                logger.warning("GPIO no accessible (%s); s'usen relés simulats", exc)
+                self.relay3 = MockRelay(pin3)
+                self.relay4 = MockRelay(pin4)
+        else:
+            self.relay3 = MockRelay(pin3)
+            self.relay4 = MockRelay(pin4)
+        self._r3_state = False
+        self._r4_state = False
+
+    def activate_relays(self, relay3_on, relay4_on):
+        """Aplica l'estat desitjat als dos relés.
+
+        Només escriu al GPIO quan l'estat canvia: cada on()/off() de
+        gpiozero acaba en una syscall, i el bucle de control crida aquest
+        mètode cada segon encara que no hi hagi transició.
+        """
+        if relay3_on != self._r3_state:
+            if relay3_on:
+                self.relay3.on()
+            else:
+                self.relay3.off()
+            self._r3_state = relay3_on
+        if relay4_on != self._r4_state:
+            if relay4_on:
+                self.relay4.on()
+            else:
+                self.relay4.off()
+            self._r4_state = relay4_on
+
+    def all_off(self):
+        self.activate_relays(False, False)
+
+    @property
+    def relay3_active(self):
+        return bool(self.relay3.is_active)
+
+    @property
+    def relay4_active(self):
+        return bool(self.relay4.is_active)
+
+
+class HistoricManager:
+    """Registre de maniobres a historic.csv (separador ';')."""
+
+    __slots__ = ("config", "historic_file")
+
+    def __init__(self, config, path=HISTORIC_FILE):
+        self.config = config
+        self.historic_file = path
+        self.initialize_historic_file()
+
+    def initialize_historic_file(self):
+        # O_CREAT|O_EXCL és atòmic: si dos controladors s'inicialitzen
+        # alhora, només un escriu la capçalera (exists+open seria una cursa).
+        try:
+            fd = os.open(self.historic_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+            csv.writer(f, delimiter=";").writerow(HISTORIC_COLUMNS)
+
+    def append_operation(self, row):
+        """Afegeix una maniobra; `row` segueix l'ordre de HISTORIC_COLUMNS."""
+        with open(self.historic_file, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f, delimiter=";").writerow(row)
+
+    def get_historic_data(self, usecols=None):
+        """Llegeix l'històric; amb `usecols` només es parsegen les columnes
+        demanades (estalvia CPU i memòria en històrics de diversos anys)."""
+        try:
+            parse_dates = ["Data_Inici"] if usecols is None or "Data_Inici" in usecols else False
+            return pd.read_csv(
+                self.historic_file,
+                sep=";",
+                usecols=usecols,
+                dtype=HISTORIC_DTYPES,
+                parse_dates=parse_dates,
+            )
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            return pd.DataFrame(columns=usecols or HISTORIC_COLUMNS)
+
+    def get_last_30_days(self):
+        df = self.get_historic_data()
+        if df.empty:
+            return df
+        cutoff = datetime.now() - timedelta(days=30)
+        return df[df["Data_Inici"] >= cutoff]
+
+    def load_last_operation_date(self):
+        """Retorna (última maniobra amb arrencada, últim manteniment)."""
+        df = self.get_historic_data(usecols=["Data_Inici", "Tipus_Maniobra"])
+        if df.empty:
+            return None, None
+        ops_with_start = df[df["Tipus_Maniobra"] != "manteniment"]
+        maintenance = df[df["Tipus_Maniobra"] == "manteniment"]
+        last_op = None
+        last_maintenance = None
+        # .iat sobre la columna és un accés escalar directe; .iloc[-1][...]
+        # construiria una Series intermèdia per fila.
+        if not ops_with_start.empty:
+            last_op = ops_with_start["Data_Inici"].iat[-1]
+        if not maintenance.empty:
+            last_maintenance = maintenance["Data_Inici"].iat[-1]
+        return last_op, last_maintenance
+
+    def purge_old_records(self):
+        """Elimina registres més antics que la retenció configurada."""
+        years = self.config.get("retencio_historic_anys", 5)
+        df = self.get_historic_data()
+        if df.empty:
+            return
+        cutoff = datetime.now() - timedelta(days=365 * years)
+        kept = df[df["Data_Inici"] >= cutoff]
+        if len(kept) < len(df):
+            kept.to_csv(self.historic_file, sep=";", index=False, date_format="%Y-%m-%d")
+
+
+def _parse_date(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):  # pd.Timestamp inclòs
+        return value.date()
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+class PumpController:
+    """Màquina d'estats de la bomba: maniobres programades, manuals i de
+    manteniment, amb les condicions de parada de seguretat."""
+
+    __slots__ = (
+        "config",
+        "tank_monitor",
+        "relay_controller",
+        "historic",
+        "pump_running",
+        "manual_mode",
+        "maintenance_mode",
+        "pump_start_time",
+        "start_levels",
+        "last_operation_date",
+        "last_maintenance_date",
+        "last_attempt_date",
+        "_lock",
+    )
+
+    def __init__(self, config):
+        self.config = config
+        self.tank_monitor = TankLevelMonitor(config.view)
+        self.relay_controller = RelayController(config.view)
+        self.historic = HistoricManager(config.view)
+        self.pump_running = False
+        self.manual_mode = False
+        self.maintenance_mode = False
+        self.pump_start_time = None
+        self.start_levels = (0.0, 0.0)
+        last_op, last_maintenance = self.historic.load_last_operation_date()
+        self.last_operation_date = _parse_date(last_op)
+        self.last_maintenance_date = _parse_date(last_maintenance)
+        # Evita re-intentar la maniobra del dia després d'un reinici si ja
+        # havia arrencat; un intent fallit, en canvi, es pot repetir.
+        self.last_attempt_date = self.last_operation_date
+        self._lock = threading.Lock()
+
+    # --- arrencada / parada -------------------------------------------------
+
+    def _start_conditions(self):
+        levels = self.tank_monitor.levels
+        return levels["baix"] > 15.0, levels["alt"] < 99.0
+
+    def start_pump(self, tipus):
+        """Arrenca la maniobra indicada ('programada', 'manual' o 'manteniment')."""
+        with self._lock:
+            if self.pump_running:
+                return False
+            relay3_on, relay4_on = self._start_conditions()
+            if tipus == "manteniment":
+                relay3_on = relay4_on = True
+            if not (relay3_on or relay4_on):
+                return False
+            levels = self.tank_monitor.levels
+            self.start_levels = (levels["baix"], levels["alt"])
+            self.pump_start_time = datetime.now()
+            self.pump_running = True
+            self.manual_mode = tipus == "manual"
+            self.maintenance_mode = tipus == "manteniment"
+            self.relay_controller.activate_relays(relay3_on, relay4_on)
+            logger.info("Maniobra %s iniciada (relé3=%s, relé4=%s)", tipus, relay3_on, relay4_on)
+            self.tank_monitor.publish("bomba/estat", "MARXA")
+            return True
+
+    def stop_pump(self):
+        """Para la bomba i registra la maniobra a l'històric."""
+        with self._lock:
+            if not self.pump_running:
+                return
+            self.relay_controller.all_off()
+            end = datetime.now()
+            start = self.pump_start_time or end
+            duration_min = round((end - start).total_seconds() / 60.0, 2)
+            if self.maintenance_mode:
+                tipus = "manteniment"
+            elif self.manual_mode:
+                tipus = "manual"
+            else:
+                tipus = "programada"
+            levels = self.tank_monitor.levels
+            row = [
+                start.strftime("%Y-%m-%d"),
+                start.strftime("%H:%M:%S"),
+                end.strftime("%Y-%m-%d"),
+                end.strftime("%H:%M:%S"),
+                duration_min,
+                round(self.start_levels[0], 1),
+                round(self.start_levels[1], 1),
+                round(levels["baix"], 1),
+                round(levels["alt"], 1),
+                tipus,
+            ]
+            self.historic.append_operation(row)
+            if tipus == "manteniment":
+                self.last_maintenance_date = start.date()
+            else:
+                self.last_operation_date = start.date()
+                # Una arrencada real (també manual) val com a maniobra del dia.
+                self.last_attempt_date = start.date()
+            self.pump_running = False
+            self.manual_mode = False
+            self.maintenance_mode = False
+            self.pump_start_time = None
+            logger.info("Maniobra %s finalitzada (%.2f min)", tipus, duration_min)
+            self.tank_monitor.publish("bomba/estat", "PARADA")
+            self._notify(tipus, row)
+
+    # --- lògica automàtica --------------------------------------------------
+
+    def _max_duration_s(self):
+        if self.maintenance_mode:
+            return self.config.get("temps_manteniment", 10)
+        if self.manual_mode:
+            return self.config.get("durada_max_manual", 10) * 60
+        return self.config.get("durada_max_maniobra", 3) * 60
+
+    def check_automatic_stop_conditions(self):
+        """Retorna True si cal parar la bomba (temps o nivells de seguretat)."""
+        if not self.pump_running:
+            return False
+        elapsed = (datetime.now() - self.pump_start_time).total_seconds()
+        if elapsed >= self._max_duration_s():
+            return True
+        if self.maintenance_mode:
+            return False
+        levels = self.tank_monitor.levels
+        return levels["baix"] < 15.0 or levels["alt"] > 99.0
+
+    def scheduled_time(self):
+        try:
+            return datetime.strptime(
+                self.config.get("hora_maniobra", "12:00"), "%H:%M"
+            ).time()
+        except ValueError:
+            return datetime.strptime("12:00", "%H:%M").time()
+
+    def next_scheduled(self):
+        """Data i hora de la propera maniobra programada."""
+        now = datetime.now()
+        candidate = datetime.combine(now.date(), self.scheduled_time())
+        if now >= candidate or self.last_attempt_date == now.date():
+            candidate += timedelta(days=1)
+        return candidate
+
+    def _maintenance_due(self, today):
+        """True si fa massa dies sense cap arrencada real ni manteniment."""
+        period = self.config.get("periode_manteniment", 10)
+        dates = [
+            d for d in (self.last_operation_date, self.last_maintenance_date) if d is not None
+        ]
+        if not dates:
+            return False
+        return (today - max(dates)).days >= period
+
+    def automatic_control_logic(self):
+        """Una passada de decisió: s'executa cada segon al fil de control."""
+        now = datetime.now()
+        if self.pump_running:
+            if self.check_automatic_stop_conditions():
+                self.stop_pump()
+            return
+        today = now.date()
+        # strptime de l'hora un sol cop per passada, no a cada comparació.
+        # Cap filtre d'hora exacta: si el controlador arrenca més tard de
+        # l'hora programada, la maniobra del dia es recupera igualment.
+        if now.time() >= self.scheduled_time() and self.last_attempt_date != today:
+            # L'intent diari es marca a part: last_operation_date queda per
+            # a arrencades reals, de manera que dies seguits sense arrencar
+            # sí que fan vèncer el període de manteniment.
+            self.last_attempt_date = today
+            if not self.start_pump("programada"):
+                logger.info("Maniobra programada sense arrencada (nivells fora de rang)")
+                self._notify("sense arrencada", None)
+        elif self._maintenance_due(today) and self.last_maintenance_date != today:
+            self.start_pump("manteniment")
+
+    def _control_loop(self):
+        while True:
+            try:
+                self.automatic_control_logic()
+            except Exception:
+                logger.exception("Error al bucle de control")
+            time.sleep(1.0)
+
+    def start(self):
+        """Arrenca el monitor MQTT i el fil de control en segon pla."""
+        self.tank_monitor.start()
+        self.historic.purge_old_records()
+        threading.Thread(target=self._control_loop, daemon=True).start()
+
+    # --- accions des del dashboard -------------------------------------------
+
+    def start_manual(self):
+        return self.start_pump("manual")
+
+    # --- notificacions -------------------------------------------------------
+
+    def _notify(self, tipus, row):
+        if not self.config.get("email_enabled", False):
+            return
+        try:
+            subject = f"Maniobra bomba {tipus} - {self.config.get('ubicacio', '')}"
+            if row is not None:
+                body = "\n".join(f"{c}: {v}" for c, v in zip(HISTORIC_COLUMNS, row))
+            else:
+                body = "La maniobra programada no ha arrencat (nivells fora de rang)."
+            msg = MIMEText(body)
+            msg["Subject"] = subject
+            msg["From"] = self.config.get("email_user")
+            msg["To"] = self.config.get("email_to")
+            with smtplib.SMTP_SSL(
+                self.config.get("email_smtp", "smtp.gmail.com"),
+                self.config.get("email_port", 465),
+            ) as server:
+                server.login(self.config.get("email_user"), self.config.get("email_pass"))
+                server.send_message(msg)
+        except Exception as exc:
+            logger.warning("No s'ha pogut enviar el correu: %s", exc)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Verifica la connexió MQTT amb el Venus OS i la recepció de nivells.
+
+Executar amb l'entorn virtual activat:
+
+    python test_mqtt.py [segons]
+
+Mostra per pantalla cada missatge de nivell rebut i un resum periòdic.
+"""
+
+import itertools
+import json
+import logging
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+
+import paho.mqtt.client as mqtt
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
+
+# Format del camí d'error precompilat: el %-style no recompila la plantilla
+# a cada missatge malformat, a diferència d'una f-string dins del callback.
+_RAW_FMT = "Missatge raw: %s -> %s"
+
+# El payload Victron té forma fixa {"value": <float>}: una regex de bytes
+# extreu el número sense passar per cap tokenitzador JSON. Si no hi ha
+# coincidència (canvi d'esquema) es recorre al descodificador de sota.
+_VALUE_RE = re.compile(rb'"value"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)')
+
+# Descodificador del camp "value": msgspec si hi és (no construeix cap dict,
+# només materialitza el float), si no pysimdjson amb un Parser reutilitzat,
+# després orjson, i com a últim recurs el json estàndard. Tots accepten bytes.
+try:
+    import msgspec
+
+    class _TankMsg(msgspec.Struct):
+        value: float = 0.0
+
+    _decode_value = msgspec.json.Decoder(_TankMsg).decode
+
+    def _payload_value(payload):
+        return _decode_value(payload).value
+
+except ImportError:
+    try:
+        import simdjson
+
+        # Un únic Parser viu per a tots els callbacks: reutilitza el buffer
+        # d'entrada i la tape, que és on simdjson guanya en payloads petits.
+        _parser = simdjson.Parser()
+
+        def _payload_value(payload):
+            try:
+                # at_pointer llegeix el camp sense construir el dict sencer.
+                return _parser.parse(payload).at_pointer("/value")
+            except KeyError:
+                return 0.0
+
+    except ImportError:
+        try:
+            import orjson
+
+            def _payload_value(payload):
+                return orjson.loads(payload).get("value", 0.0)
+
+        except ImportError:
+
+            def _payload_value(payload):
+                return json.loads(payload).get("value", 0.0)
+
+
+class MQTTTester:
+    """Client MQTT mínim que es subscriu als dos nivells de dipòsit."""
+
+    # Buidat del buffer de sortida: per mida o per temps, el que arribi abans.
+    _FLUSH_EVERY = 32
+    _FLUSH_INTERVAL_S = 0.25
+
+    __slots__ = (
+        "config",
+        "client",
+        "messages_received",
+        "_counter",
+        "_inc",
+        "_tank_digit",
+        "_low_topic",
+        "_high_topic",
+        "_log_buf",
+        "_log_lock",
+        "_log_last_flush",
+        "_last_sec",
+        "_last_ts",
+        "_log_info",
+        "_stop",
+        "_message_goal",
+    )
+
+    def __init__(self, config_file="config.json"):
+        # Escalfa el descodificador json: inofensiu a CPython, i en ports
+        # MicroPython/CircuitPython evita el camí lent del primer loads.
+        json.loads("0")
+        with open(config_file, encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.messages_received = 0
+        # Comptador C d'itertools: una crida lligada i un store en lloc de
+        # llegir-sumar-desar l'atribut a cada missatge; messages_received
+        # s'actualitza amb el mateix assignament encadenat.
+        self._counter = itertools.count(1)
+        self._inc = self._counter.__next__
+        # Els topics no canvien en tota la sessió: es formaten un sol cop
+        # aquí i on_connect només els reutilitza a cada (re)connexió.
+        device_id = self.config.get("victron_device_id", "")
+        self._low_topic = f"N/{device_id}/tank/3/Level"
+        self._high_topic = f"N/{device_id}/tank/4/Level"
+        # Els dos topics només difereixen en el dígit del port, a 7
+        # posicions del final ('X/Level'): indexar un únic caràcter evita
+        # el hash de tot el topic a cada missatge.
+        self._tank_digit = {"3": "baix", "4": "alt"}
+        self._log_buf = []
+        self._log_lock = threading.Lock()
+        self._log_last_flush = time.monotonic()
+        self._last_sec = 0
+        self._last_ts = ""
+        self._stop = threading.Event()
+        self._message_goal = None
+        # Avaluat un cop: si INFO està desactivat, el camí calent no paga
+        # ni el formatat ni la crida al logger.
+        self._log_info = logger.isEnabledFor(logging.INFO)
+        # Amb paho >= 2 es negocia MQTT v5: permet apujar Receive Maximum
+        # perquè el broker no seriï els PUBLISH esperant acks un a un.
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+        else:
+            self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        failed = rc.is_failure if hasattr(rc, "is_failure") else rc != 0
+        if failed:
+            logger.error("Connexió rebutjada pel broker (rc=%s)", rc)
+            return
+        for topic in (self._low_topic, self._high_topic):
+            client.subscribe(topic)
+            logger.info("Subscrit a %s", topic)
+
+    def on_message(self, client, userdata, msg):
+        self.messages_received = n = self._inc()
+        if self._message_goal is not None and n >= self._message_goal:
+            self._stop.set()
+        topic = msg.topic
+        try:
+            m = _VALUE_RE.search(msg.payload)
+            value = float(m.group(1)) if m else _payload_value(msg.payload)
+            # value està dins [0,1]; amb un sol decimal n'hi ha prou, així
+            # que es formata amb enters escalats (dos divmods) en lloc del
+            # dtoa complet de formatar un float.
+            tenths = int(value * 1000 + 0.5)
+            # topic[-7:-6] en lloc de [-7]: un slice buit en topics curts no
+            # aixeca IndexError i cau al valor per defecte.
+            tank_type = self._tank_digit.get(topic[-7:-6], "desconegut")
+            # El timestamp formatat només canvia un cop per segon: es
+            # reutilitza en lloc de crear datetime + strftime per missatge.
+            s = int(time.time())
+            if s != self._last_sec:
+                self._last_sec = s
+                self._last_ts = datetime.fromtimestamp(s).strftime("%H:%M:%S")
+            # El print per missatge és una syscall cada vegada i reté el GIL
+            # al fil de xarxa de paho: s'acumula i es buida en bloc. L'append
+            # va sota el mateix lock que el buidat; si no, una línia afegida
+            # mentre el flusher despenja la llista es perdria en silenci.
+            line = f"[{self._last_ts}] Dipòsit {tank_type}: {tenths // 10}.{tenths % 10}%\n"
+            with self._log_lock:
+                self._log_buf.append(line)
+                full = len(self._log_buf) >= self._FLUSH_EVERY
+            if full:
+                self._flush_log()
+        except (ValueError, AttributeError):
+            # ValueError cobreix json/orjson/msgspec; AttributeError, JSON
+            # vàlid que no és un objecte. Es reutilitza `topic`: la propietat
+            # msg.topic de paho descodifica els bytes a cada accés.
+            print(_RAW_FMT % (topic, msg.payload))
+
+    def _flush_log(self):
+        with self._log_lock:
+            buf, self._log_buf = self._log_buf, []
+        if not buf:
+            return
+        self._log_last_flush = time.monotonic()
+        sys.stdout.write("".join(buf))
+        if self._log_info:
+            logger.info("%d missatges mostrats (total %d)", len(buf), self.messages_received)
+
+    def run_test(self, duration=60, message_goal=None):
+        broker = self.config.get("mqtt_broker")
+        port = self.config.get("mqtt_port", 1883)
+        self._message_goal = message_goal
+        self._stop.clear()
+        # Ctrl-C marca l'Event i desbloqueja el wait() immediatament, en
+        # lloc d'esperar que el sleep es desperti per rebre l'excepció.
+        try:
+            signal.signal(signal.SIGINT, lambda *_: self._stop.set())
+        except ValueError:
+            pass  # fora del fil principal: queda el KeyboardInterrupt
+        print(f"Connectant a {broker}:{port} durant {duration} s...")
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            from paho.mqtt.packettypes import PacketTypes
+            from paho.mqtt.properties import Properties
+
+            props = Properties(PacketTypes.CONNECT)
+            props.ReceiveMaximum = 1024
+            self.client.connect(broker, port, 60, clean_start=True, properties=props)
+        else:
+            self.client.connect(broker, port, 60)
+        # Buffer de recepció gran: les ràfegues del broker s'absorbeixen al
+        # kernel en lloc de frenar el TCP mentre Python processa callbacks.
+        try:
+            self.client.socket().setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        except (OSError, AttributeError):
+            pass
+        self.client.loop_start()
+        # Fil que limita la latència del buffer quan el trànsit és baix.
+        flusher_stop = threading.Event()
+
+        def _flusher():
+            while not flusher_stop.wait(self._FLUSH_INTERVAL_S):
+                if time.monotonic() - self._log_last_flush >= self._FLUSH_INTERVAL_S:
+                    self._flush_log()
+
+        threading.Thread(target=_flusher, daemon=True).start()
+        # time.monotonic: immune a canvis de rellotge; next_print garanteix
+        # exactament un resum cada 30 s (el mòdul per segon podia duplicar-lo).
+        start_time = time.monotonic()
+        deadline = start_time + duration
+        next_print = start_time + 30
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if self._stop.wait(min(deadline, next_print) - now):
+                    break
+                if time.monotonic() >= next_print:
+                    print(
+                        f"... {self.messages_received} missatges en "
+                        f"{int(time.monotonic() - start_time)} s"
+                    )
+                    next_print += 30
+        except KeyboardInterrupt:
+            print("Interromput per l'usuari")
+        finally:
+            flusher_stop.set()
+            self.client.loop_stop()
+            self.client.disconnect()
+            self._flush_log()
+        print(f"Test acabat: {self.messages_received} missatges rebuts")
+        return self.messages_received
+
+
+if __name__ == "__main__":
+    duration = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    MQTTTester().run_test(duration)